@@ -1,4 +1,4 @@
-from match.dsl import MatchDSL
+from match.dsl import MatchDSL, HAS_JIT
 
 m = MatchDSL()
 
@@ -83,6 +83,28 @@ m = MatchDSL() # just resetting
 (m.w_integer + +(m['+'] + m.w_integer))             // 'sum'
 # m.sum will now match arithmetic sums!
 
+# SPAN finds where the match ends without building the tree of matches
+sum_source = '12 + -3 + 0 +  456 '
+assert(m.sum.SPAN(sum_source) == m.sum(sum_source).end)
+assert(m.sum.SPAN('1 + 2 + é') == m.sum('1 + 2 + é').end)
+# with numba installed it runs as compiled machine code, except on sources
+# that cannot be encoded for it, which fall back to the Python VM
+if HAS_JIT:
+    assert(m.sum.SPAN('1 + 2\ud800') == m.sum('1 + 2\ud800').end)
+# SPECIALIZE generates a Python function for the matcher that does the same
+assert(m.sum.SPECIALIZE()(sum_source) == m.sum(sum_source).end)
+# COMPILE_DFA replaces a stored matcher with one that matches the same text in
+# a single loop over the source, with that text as its only token
+sum_match = m.sum(sum_source).get_match()
+m.COMPILE_DFA('sum')
+assert(m.sum(sum_source).get_match() == sum_match)
+assert(m.sum(sum_source).tokens == [sum_match])
+# where the next character does not decide between the options, the matcher
+# tree is kept, and so are its tokens
+(m['a'] | m['ab']) // 'a_or_ab'
+m.COMPILE_DFA('a_or_ab')
+assert(m.a_or_ab('ab').tokens[0].get_match() == 'a')
+
 # we can also do this in a pseudo one liner...
 # using \ to break for "readability"
 n = MatchDSL()
@@ -99,3 +121,25 @@ n.BETWEEN('1', '9').STORE('non_zero_digit').OR(n.MATCH('0')).STORE('digit')\
 # once more for luck?
 _ = MatchDSL()
 ((((+((_['0']|(~_['-']+(((((_<('1','9'))//'nzd')|_['0'])//'d').nzd++_.d)))//'int')[' ']//'ws')+_.int+_.ws)//'wint')++(_['+']+_.wint))//'sum'
+
+# a rule referring to itself before consuming anything fails there rather than
+# recursing forever, so only the second option of e can match
+l = MatchDSL()
+l['x']//'e'
+(l.e + l['+'] + l['x'] | l['x'])//'e'
+assert(l.e('x+x').end == 1)
+assert(l.e.SPAN('x+x') == 1)
+assert(l.e.SPECIALIZE()('x+x') == 1)
+
+# the same goes for rules referring to each other, where which options fail
+# depends on the rules being matched around them
+r = MatchDSL()
+r['a']//'A'
+r['b']//'B'
+(r.A + r['x'] | r['a'])//'A'
+(r.A | r['b'])//'B'
+(r.B + r['x'] | r['a'])//'A'
+((r.A + r['q']) | (r.B + r['z']))//'C'
+assert(r.C('az').end == 2)
+assert(r.C.SPAN('az') == 2)
+assert(r.C.SPECIALIZE()('az') == 2)
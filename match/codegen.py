@@ -0,0 +1,99 @@
+"""
+Generates a plain Python function specialised to a single matcher, so that
+the choices the matcher tree makes through method calls on every match are
+made once, when the source of the function is written.
+
+Each matcher writes the statements that perform its match with emit_python:
+they start at the index pos, advance pos past what was matched and return -1
+from the enclosing function when the match fails. A matcher that has to be
+tried without failing the enclosing function, such as an option of an
+AnyMatcher, is given a function of its own with Context.function.
+
+A rule, the matcher bound to a name, gets a function from Context.rule. When the
+rule can refer back to itself before consuming, the function fails when it is
+called again at a position it is already being matched at, as vm.execute does,
+so left recursion cannot recurse forever. Every generated function takes
+(buf, pos, n, active), where active holds those flags.
+"""
+from textwrap import indent
+
+
+class Context:
+    """
+    Collects the generated functions for one call to specialize
+    """
+    def __init__(self):
+        self.functions = {}
+        self.sources = []
+        self.namespace = {}
+        self.rules = 0
+
+    def function(self, matcher, key=None)-> str:
+        """
+        Generates a function performing the match of matcher, once per key
+        :param key: identifies the function; defaults to the identity of matcher
+        :return: the name of the function, which takes (buf, pos, n, active) and
+            returns the index at which the match ended, or -1
+        """
+        key = id(matcher) if key is None else key
+        if key not in self.functions:
+            name = '_match_{}'.format(len(self.functions))
+            # registered before the body is emitted so that recursive references resolve
+            self.functions[key] = name
+            body = matcher.emit_python(self) or 'pass'
+            self.sources.append('def {}(buf, pos, n, active):\n{}\n    return pos\n'.format(name, indent(body, '    ')))
+        return self.functions[key]
+
+    def rule(self, matcher, name: str)-> str:
+        """
+        Generates a function performing the match of the rule bound to name, once
+        per name; if the rule is left recursive, the function fails when the rule
+        is already being matched at pos
+        :return: the name of the function, which is called as those of Context.function are
+        """
+        if name not in self.functions:
+            if name not in matcher.left_calls(frozenset([name])):
+                # only a left recursive rule can be called again at the position it is being matched at
+                return self.function(matcher, name)
+            entry = '_match_{}'.format(len(self.functions))
+            self.functions[name] = entry
+            rule = self.rules
+            self.rules += 1
+            body = matcher.emit_python(self) or 'pass'
+            self.sources.append(
+                'def {}(buf, pos, n, active):\n'
+                '    slot = {} * (n + 1) + pos\n'
+                '    if active[slot]:\n'
+                '        return -1\n'
+                '    active[slot] = 1\n'
+                '    try:\n'
+                '{}\n'
+                '        return pos\n'
+                '    finally:\n'
+                '        active[slot] = 0\n'.format(entry, rule, indent(body, '        ')))
+        return self.functions[name]
+
+    def const(self, value)-> str:
+        """
+        Makes value available to the generated code
+        :return: the name the generated code refers to it by
+        """
+        name = '_const_{}'.format(len(self.namespace))
+        self.namespace[name] = value
+        return name
+
+
+def specialize(matcher):
+    """
+    :return: a function taking (source, pos=0) and returning the index in source
+        at which the match of matcher ends, or -1 if it fails
+    """
+    context = Context()
+    entry = context.function(matcher)
+    source = '\n'.join(context.sources) + (
+        '\ndef run(source, pos=0):\n'
+        '    n = len(source)\n'
+        '    return {}(source, pos, n, bytearray({} * (n + 1)))\n'.format(entry, context.rules))
+    namespace = dict(context.namespace)
+    exec(compile(source, '<match {}>'.format(getattr(matcher, 'name', '') or entry), 'exec'), namespace)
+    return namespace['run']
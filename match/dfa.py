@@ -0,0 +1,90 @@
+"""
+Conversion of matchers to DFAs. A matcher is first built into a Thompson NFA,
+with the NFA fragment for each matcher emitted by its emit_nfa method, and
+the NFA is then determinized by subset construction.
+
+Matchers backtrack and take the first option that succeeds, whereas a DFA
+finds the longest prefix it accepts. The two agree whenever the next
+character alone decides every choice a matcher makes, so determinize refuses
+any NFA in which two of the states reachable together have transitions on a
+common character by raising NotRegular; such grammars are left to the matcher
+tree.
+"""
+
+# most transitions a single DFA state may expand its character ranges into
+_MAX_TRANSITIONS = 1 << 16
+
+
+class NotRegular(Exception):
+    """
+    Raised when a matcher cannot be replaced by a DFA that matches exactly as it does
+    """
+
+
+class NFA:
+    """
+    A Thompson NFA; transitions are on inclusive ranges of code points
+    """
+    def __init__(self):
+        self.epsilons = []
+        self.edges = []
+
+    def state(self)-> int:
+        """
+        :return: a new state with no transitions
+        """
+        self.epsilons.append([])
+        self.edges.append([])
+        return len(self.edges) - 1
+
+    def epsilon(self, source: int, target: int):
+        self.epsilons[source].append(target)
+
+    def edge(self, source: int, lower: int, upper: int, target: int):
+        self.edges[source].append((lower, upper, target))
+
+    def closure(self, states)-> frozenset:
+        """
+        :return: the states reachable from states through epsilon transitions alone
+        """
+        closure = set(states)
+        pending = list(states)
+        while pending:
+            for target in self.epsilons[pending.pop()]:
+                if target not in closure:
+                    closure.add(target)
+                    pending.append(target)
+        return frozenset(closure)
+
+
+def determinize(nfa: NFA, start: int, end: int):
+    """
+    :param nfa: the NFA to convert
+    :param start: the start state of the NFA
+    :param end: the only accepting state of the NFA
+    :return: (transitions, accept) where transitions[state] maps a character to the
+        next state, accept is the set of accepting states and 0 is the start state
+    """
+    ids = {nfa.closure([start]): 0}
+    subsets = [nfa.closure([start])]
+    transitions = []
+    accept = set()
+    for state, subset in enumerate(subsets):
+        if end in subset:
+            accept.add(state)
+        edges = sorted(edge for nfa_state in subset for edge in nfa.edges[nfa_state])
+        for (_, upper, _), (lower, _, _) in zip(edges, edges[1:]):
+            if lower <= upper:
+                raise NotRegular("the next character does not decide between two options")
+        if sum(upper - lower + 1 for lower, upper, _ in edges) > _MAX_TRANSITIONS:
+            raise NotRegular("the character ranges are too wide to tabulate")
+        table = {}
+        for lower, upper, target in edges:
+            target = nfa.closure([target])
+            if target not in ids:
+                ids[target] = len(subsets)
+                subsets.append(target)
+            for code in range(lower, upper + 1):
+                table[chr(code)] = ids[target]
+        transitions.append(table)
+    return transitions, accept
@@ -1,33 +1,102 @@
+from logging import getLogger
 from match.matchers import LiteralMatcher, SequenceMatcher,\
     RangeMatcher, AnyMatcher, RefMatcher, RepeatedMatcher,\
-    NotMatcher, OptionalMatcher
+    NotMatcher, OptionalMatcher, DFAMatcher, Registry, bindings_of, stale
+from match.dfa import NotRegular
+from match.codegen import specialize
+
+try:
+    from match import jit
+except ImportError:
+    # numba is optional; without it SPAN runs on the pure Python VM
+    jit = None
+
+# whether SPAN runs on the Numba kernel
+HAS_JIT = jit is not None
+
+logger = getLogger(__name__)
 
 class MatchDSL:
     def __init__(self):
-        self.registry = {}
+        self.registry = Registry()
+        # wrappers returned for dotted references, shared by every MatchDSL on the registry;
+        # their RefMatchers resolve late and their compiled caches check the registry
+        # versions, so they stay valid when a name is rebound
+        self._refs = {}
         self.last = None
+        # compiled on first use, along with the bindings they were compiled against;
+        # both copy the rules they call, so they are rebuilt once one is rebound
+        self._program = None
+        self._program_bindings = None
+        self._specialized = None
+        self._specialized_bindings = None
     
     def _new(self, matcher):
         m = MatchDSL()
         m.registry = self.registry
+        m._refs = self._refs
         m.last = matcher
         return m
 
     def __call__(self, source):
         if not self.last:
             raise ValueError("Attempting to match when no matcher defined")
-        return self.last.match(source)
+        return self.last(source)
+
+    def SPAN(self, source):
+        """
+        Matches source without building a Match tree, using a Program compiled
+        from the matcher on first use; the Program is run by the Numba kernel in
+        match.jit when numba is installed
+        :return: the index in source at which the match ends, or -1 if it fails
+        """
+        if self.last is None:
+            raise ValueError("Attempting to match when no matcher defined")
+        if self._program is None or stale(self._program_bindings):
+            self._program = self.last.compile()
+            self._program_bindings = bindings_of(self.last)
+        if jit is not None and jit.supports(self._program):
+            return jit.run(self._program, source)
+        return self._program.run(source)
     
     def MATCH(self, literal):
         return self._new(LiteralMatcher('', literal))
 
     def STORE(self, name):
-        self.registry[name] = self.last
+        self.registry.bind(name, self.last)
         self.last.name = name
         return self
 
+    def SPECIALIZE(self):
+        """
+        Generates a Python function specialised to the matcher, on first use
+        :return: a function taking (source, pos=0) and returning the index in source
+            at which the match ends, or -1 if it fails
+        """
+        if self.last is None:
+            raise ValueError("Attempting to match when no matcher defined")
+        if self._specialized is None or stale(self._specialized_bindings):
+            self._specialized = specialize(self.last)
+            self._specialized_bindings = bindings_of(self.last)
+        return self._specialized
+
+    def COMPILE_DFA(self, name):
+        """
+        Replaces the matcher stored as name with a DFAMatcher, which matches in a single
+        loop over the source but reports only the matched text, not a tree of Matches.
+        The stored matcher is kept when it has no equivalent DFA, for example when it
+        refers to itself or the next character does not decide between its options.
+        """
+        try:
+            self.registry.bind(name, DFAMatcher(name, self.registry[name]))
+        except NotRegular as e:
+            logger.info("Keeping the matcher tree for {}: {}".format(name, e))
+        return self
+
     def REF(self, name):
-        return self._new(self.registry[name])
+        if name not in self.registry:
+            raise KeyError(name)
+        return self._new(RefMatcher(name, self.registry))
 
     def THEN(self, seq):
         if type(seq) is MatchDSL:
@@ -57,7 +126,14 @@ class MatchDSL:
         return self._new(OptionalMatcher('', self.last))
 
     def __getattr__(self, name):
-        return self.REF(name)
+        # only called when normal lookup fails; special names looked up by copy,
+        # pickle and the like are not references
+        if name.startswith('__'):
+            raise AttributeError(name)
+        ref = self._refs.get(name)
+        if ref is None:
+            ref = self._refs[name] = self.REF(name)
+        return ref
 
     def __xor__(self, name):
         return self.STORE(name)
@@ -0,0 +1,166 @@
+"""
+A Numba compiled version of the loop in match.vm.execute. Requires numba and
+numpy, which are optional; match.dsl falls back to the pure Python loop when
+they cannot be imported.
+
+Numba cannot work with str efficiently, so the source is handed to the kernel
+as an array of code points, and the constants of a Program are re-encoded as
+integers: a literal becomes an offset and a length into a single array of code
+points, and a range becomes its two bounds as code points.
+"""
+from weakref import WeakKeyDictionary
+
+import numba
+import numpy as np
+
+from match.vm import Program, LITERAL, ILITERAL, RANGE, ANY, CHOICE, COMMIT,\
+    PARTIAL_COMMIT, FAIL_TWICE, CALL, RETURN, END
+
+_encoded = WeakKeyDictionary()
+
+
+def supports(program: Program)-> bool:
+    """
+    Case insensitive literals are not supported by the kernel
+    """
+    return ILITERAL not in program.ops
+
+
+def encode(program: Program):
+    """
+    :return: the (ops, a, b, codes) arrays the kernel runs, cached per program
+    """
+    if program in _encoded:
+        return _encoded[program]
+    a = list(program.a)
+    b = list(program.b)
+    codes = []
+    for pc, op in enumerate(program.ops):
+        if op == LITERAL:
+            a[pc] = len(codes)
+            codes.extend(ord(c) for c in program.consts[program.a[pc]])
+        elif op == RANGE:
+            a[pc] = ord(program.consts[program.a[pc]])
+            b[pc] = ord(program.consts[program.b[pc]])
+    encoded = (
+        np.array(program.ops, dtype=np.int32),
+        np.array(a, dtype=np.int32),
+        np.array(b, dtype=np.int32),
+        np.array(codes, dtype=np.int32),
+    )
+    _encoded[program] = encoded
+    return encoded
+
+
+def run(program: Program, source: str, pos: int=0)-> int:
+    """
+    :return: the index in source at which the match ended, or -1 if it failed
+    """
+    try:
+        data = source.encode('utf-32-le')
+    except UnicodeEncodeError:
+        # lone surrogates have no UTF-32 encoding; the pure Python loop accepts them
+        return program.run(source, pos)
+    ops, a, b, codes = encode(program)
+    buf = np.frombuffer(data, dtype='<u4')
+    return int(_execute(ops, a, b, codes, len(program.rule_ids), buf, pos))
+
+
+@numba.njit(cache=True)
+def _grow(stack):
+    grown = np.empty(stack.shape[0] * 2, dtype=stack.dtype)
+    grown[:stack.shape[0]] = stack
+    return grown
+
+
+@numba.njit(cache=True)
+def _execute(ops, a, b, codes, rules, buf, pos):
+    n = buf.shape[0]
+    width = n + 1
+    active = np.zeros(rules * width, dtype=np.uint8)
+    # same layout as the stack in match.vm.execute, with sp pointing past the top pair
+    stack = np.empty(64, dtype=np.int64)
+    sp = 0
+    pc = 0
+    while True:
+        op = ops[pc]
+        ok = True
+        if op == LITERAL:
+            length = b[pc]
+            offset = a[pc]
+            if pos + length > n:
+                ok = False
+            else:
+                for i in range(length):
+                    if buf[pos + i] != codes[offset + i]:
+                        ok = False
+                        break
+            if ok:
+                pos += length
+                pc += 1
+        elif op == RANGE:
+            if pos < n and a[pc] <= buf[pos] <= b[pc]:
+                pos += 1
+                pc += 1
+            else:
+                ok = False
+        elif op == CHOICE:
+            if sp + 2 > stack.shape[0]:
+                stack = _grow(stack)
+            stack[sp] = a[pc]
+            stack[sp + 1] = pos
+            sp += 2
+            pc += 1
+        elif op == COMMIT:
+            sp -= 2
+            pc = a[pc]
+        elif op == PARTIAL_COMMIT:
+            if pos >= n:
+                sp -= 2
+                pc += 1
+            elif pos == stack[sp - 1]:
+                raise ValueError("repetition matched without consuming, so it would loop forever")
+            else:
+                stack[sp - 1] = pos
+                pc = a[pc]
+        elif op == CALL:
+            slot = b[pc] * width + pos
+            if active[slot]:
+                ok = False
+            else:
+                active[slot] = 1
+                if sp + 2 > stack.shape[0]:
+                    stack = _grow(stack)
+                stack[sp] = pc + 1
+                stack[sp + 1] = -1 - slot
+                sp += 2
+                pc = a[pc]
+        elif op == RETURN:
+            sp -= 2
+            active[-1 - stack[sp + 1]] = 0
+            pc = stack[sp]
+        elif op == ANY:
+            if pos < n:
+                pos += 1
+                pc += 1
+            else:
+                ok = False
+        elif op == FAIL_TWICE:
+            sp -= 2
+            ok = False
+        elif op == END:
+            return pos
+        else:
+            ok = False
+        if not ok:
+            resumed = False
+            while sp > 0:
+                sp -= 2
+                if stack[sp + 1] >= 0:
+                    pos = stack[sp + 1]
+                    pc = stack[sp]
+                    resumed = True
+                    break
+                active[-1 - stack[sp + 1]] = 0
+            if not resumed:
+                return -1
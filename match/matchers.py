@@ -1,9 +1,79 @@
+import re
+import sys
 from logging import getLogger
-from typing import List, TypeVar
+from typing import List, TypeVar, Optional, FrozenSet
 from abc import ABC, abstractmethod
+from match.vm import Program, LITERAL, ILITERAL, RANGE, ANY, CHOICE, COMMIT,\
+    PARTIAL_COMMIT, FAIL_TWICE, FAIL
+from match.dfa import NFA, NotRegular, determinize
+from match.codegen import Context
 
 logger = getLogger(__name__)
 
+# widest RangeMatcher an AnyMatcher will expand into its first character table,
+# and that first_set will enumerate
+_MAX_DISPATCH_RANGE = 256
+
+# shared by every Match that has no tokens, failures above all
+_EMPTY_TOKENS = ()
+
+# marks a reference as being matched at a position in the memo
+_ACTIVE = object()
+
+
+class Registry(dict):
+    """
+    The matchers of a grammar by name. version counts the names bound with bind, so
+    that a cache built by looking through references into the registry can tell
+    when it has to be rebuilt; see bindings_of
+    """
+    __slots__ = ('version',)
+
+    def __init__(self):
+        super().__init__()
+        self.version = 0
+
+    def bind(self, name: str, matcher: 'Matcher'):
+        self[name] = matcher
+        self.version += 1
+
+
+def bindings_of(matcher: 'Matcher')-> tuple:
+    """
+    :return: a (registry, version) pair for every Registry that matcher refers
+        through, following references as they are currently bound
+    """
+    bindings = []
+    pending = [matcher]
+    visited = set()
+    while pending:
+        matcher = pending.pop()
+        if id(matcher) in visited:
+            continue
+        visited.add(id(matcher))
+        if type(matcher) is RefMatcher:
+            registry = matcher.registry
+            if isinstance(registry, Registry) and all(seen is not registry for seen, _ in bindings):
+                bindings.append((registry, registry.version))
+            if matcher.ref_name in registry:
+                pending.append(registry[matcher.ref_name])
+        else:
+            # the combinators keep their children as matchers or matcher
+            pending.extend(getattr(matcher, 'matchers', ()))
+            if getattr(matcher, 'matcher', None) is not None:
+                pending.append(matcher.matcher)
+    return tuple(bindings)
+
+
+def stale(bindings: tuple)-> bool:
+    """
+    :return: whether a name has been bound in any of the registries since bindings_of returned bindings
+    """
+    for registry, version in bindings:
+        if registry.version != version:
+            return True
+    return False
+
 class Match:
     """
     Container returned by matchers with details of the match
@@ -11,17 +81,30 @@ class Match:
     tokens list, with instances of Match acting as nodes and
     strings acting as the leaves
     """
-    def __init__(self, successful: bool, name: str, tokens: list, remainder: str):
+    __slots__ = ('successful', 'name', 'tokens', 'buf', 'start', 'end')
+
+    def __init__(self, successful: bool, name: str, tokens: list, buf: str, start: int, end: int):
         """
         :param successful: flag indicating if the match was successful
         :param name: the name of the matching function that was run to achieve this Match
-        :param tokens: list of tokens matched by the Matcher (str or Match)
-        :param remainder: the contents of the string following the match
+        :param tokens: list or tuple of tokens matched by the Matcher (str or Match)
+        :param buf: the complete source string the match was run against
+        :param start: the index in buf at which the match started
+        :param end: the index in buf at which the match ended
         """
         self.successful = successful
         self.name = name
         self.tokens = tokens
-        self.remainder = remainder
+        self.buf = buf
+        self.start = start
+        self.end = end
+
+    @property
+    def remainder(self):
+        """
+        The contents of the string following the match
+        """
+        return self.buf[self.end:]
 
     def __repr__(self, indent=0):
         token_repr = "\n".join([t.__repr__(indent+1) if isinstance(t, Match) else t.__repr__() for t in self.tokens])
@@ -47,25 +130,161 @@ class Match:
         return own_description.format(name=self.name, children=children_repr, indent=" "*indent)
 
     def get_match(self):
-        return "".join([
-            t if type(t) is str 
-            else t.get_match()
-            for t in self.tokens
-        ])
+        return self.buf[self.start:self.end]
+
+
+class LazyMatch(Match):
+    """
+    A successful Match whose tokens are only built when they are first read
+    """
+    __slots__ = ('_expand', '_memo', '_tokens')
+
+    def __init__(self, name: str, buf: str, start: int, end: int, expand, memo: dict):
+        """
+        :param name: the name of the matching function that was run to achieve this Match
+        :param buf: the complete source string the match was run against
+        :param start: the index in buf at which the match started
+        :param end: the index in buf at which the match ended
+        :param expand: called with (buf, start, end, memo) to build the list of tokens
+        :param memo: the memo of the match that produced this Match, reused to build the tokens
+        """
+        self.successful = True
+        self.name = name
+        self.buf = buf
+        self.start = start
+        self.end = end
+        self._expand = expand
+        self._memo = memo
+        self._tokens = None
+
+    @property
+    def tokens(self):
+        if self._tokens is None:
+            self._tokens = self._expand(self.buf, self.start, self.end, self._memo)
+            self._memo = None
+        return self._tokens
     
 
+def _char_class(matcher: 'Matcher', seen: set):
+    """
+    Describes the characters matched by a matcher that only ever matches a single
+    character, following references as they are currently bound
+    :param matcher: the matcher to describe
+    :param seen: names of the references followed to reach this matcher
+    :return: the body of an equivalent regex character class, or None if there is none
+    """
+    if type(matcher) is LiteralMatcher:
+        if len(matcher.literal) == 1 and matcher.case_sensitive:
+            return re.escape(matcher.literal)
+    elif type(matcher) is RangeMatcher:
+        if matcher.lbound <= matcher.ubound:
+            return '{}-{}'.format(re.escape(chr(matcher.lbound)), re.escape(chr(matcher.ubound)))
+    elif type(matcher) is AnyMatcher:
+        classes = [_char_class(option, seen) for option in matcher.matchers]
+        if classes and all(classes):
+            return ''.join(classes)
+    elif type(matcher) is RefMatcher:
+        if matcher.ref_name not in seen and matcher.ref_name in matcher.registry:
+            return _char_class(matcher.registry[matcher.ref_name], seen | {matcher.ref_name})
+    return None
+
+
 class Matcher(ABC):
+    __slots__ = ('_name', '_fail')
+
+    @property
+    def name(self)-> str:
+        return self._name
+
+    @name.setter
+    def name(self, name: str):
+        self._name = sys.intern(name)
+        # every failure of this matcher returns the same Match; a failed match
+        # is only ever checked for success, so it carries no position or source
+        self._fail = Match(False, self._name, _EMPTY_TOKENS, '', 0, 0)
+
     @abstractmethod
-    def match(self, source: str)-> Match:
+    def match(self, buf: str, pos: int, memo: dict)-> Match:
+        """
+        :param buf: the complete source string being matched
+        :param pos: the index in buf at which to start matching
+        :param memo: results for referenced matchers; memo[id(matcher)][pos] is the
+            result of matcher at pos, in a list allocated on first use
+        """
         raise NotImplementedError("Derived classes must override the match function")
 
     def __call__(self, source):
-        return self.match(source)
+        return self.match(source, 0, {})
+
+    @abstractmethod
+    def emit_program(self, program: Program):
+        """
+        Appends the instructions that perform this match to program
+        """
+        raise NotImplementedError("Derived classes must override the emit_program function")
+
+    @abstractmethod
+    def nullable(self, seen: frozenset=frozenset())-> bool:
+        """
+        :param seen: names of the references followed to reach this matcher
+        :return: whether this matcher can succeed without consuming any input
+        """
+        raise NotImplementedError("Derived classes must override the nullable function")
+
+    def first_set(self, seen: frozenset=frozenset())-> Optional[FrozenSet[str]]:
+        """
+        :param seen: names of the references followed to reach this matcher
+        :return: the characters a non-empty match can start with, or None if that is not known
+        """
+        return None
+
+    @abstractmethod
+    def left_calls(self, seen: frozenset=frozenset())-> FrozenSet[str]:
+        """
+        :param seen: names of the references followed to reach this matcher
+        :return: the names of the rules this matcher may refer to, directly or through
+            other rules, before it has consumed any input
+        """
+        raise NotImplementedError("Derived classes must override the left_calls function")
+
+    def emit_nfa(self, nfa: NFA, start: int, seen: frozenset=frozenset())-> int:
+        """
+        Adds the states that perform this match to nfa
+        :param start: the state the match starts from
+        :param seen: names of the references followed to reach this matcher
+        :return: the state reached once the match has succeeded
+        """
+        raise NotRegular("{} cannot be converted to a DFA".format(type(self).__name__))
+
+    @abstractmethod
+    def emit_python(self, ctx: Context)-> str:
+        """
+        :return: Python statements that advance pos past this match, or return -1
+            when it fails; see match.codegen
+        """
+        raise NotImplementedError("Derived classes must override the emit_python function")
+
+    def emit_python_end(self, ctx: Context)-> str:
+        """
+        :return: a Python expression for the index at which this match ends when
+            started from pos, or -1 when it fails; pos itself is left unchanged
+        """
+        return '{}(buf, pos, n, active)'.format(ctx.function(self))
+
+    def compile(self)-> Program:
+        """
+        Compiles this matcher, along with every matcher it refers to, into a flat Program
+        """
+        program = Program()
+        self.emit_program(program)
+        return program.finish()
 
 class LiteralMatcher(Matcher):
     """
     Matches exactly the supplied literal
     """
+    __slots__ = ('literal', 'case_sensitive', '_lit', '_nlit')
+
     def __init__(self, name: str, literal: str, case_sensitive: bool=True):
         """
         :param name: string to identify this matcher
@@ -77,19 +296,87 @@ class LiteralMatcher(Matcher):
             logger.warning("Matching on an empty literal in {}".format(name))
         self.literal = literal
         self.case_sensitive = case_sensitive
+        # the lowered literal is computed once here rather than on every match
+        self._lit = literal if case_sensitive else literal.lower()
+        self._nlit = len(literal)
 
-    def match(self, source: str)-> Match:
-        _source = source if self.case_sensitive else source.lower()
-        _literal = self.literal if self.case_sensitive else self.literal.lower()
-        if _source.startswith(_literal):
-            return Match(True, self.name, [self.literal], source[len(self.literal):])
-        return Match(False, self.name, [], source)
+    def match(self, buf: str, pos: int, memo: dict)-> Match:
+        end = pos + self._nlit
+        if self.case_sensitive:
+            if buf.startswith(self.literal, pos):
+                return Match(True, self._name, [self.literal], buf, pos, end)
+        else:
+            # the token is the text as it appears in the source, so that every
+            # token is a slice of the source
+            token = buf[pos:end]
+            if token.lower() == self._lit:
+                return Match(True, self._name, [token], buf, pos, end)
+        return self._fail
+
+    def bulk_consume(self, buf: str, pos: int)-> int:
+        """
+        Matches the literal as many times as possible without building Matches
+        :return: the index in buf after the last repetition
+        """
+        literal, nlit = self.literal, self._nlit
+        if self.case_sensitive:
+            while buf.startswith(literal, pos):
+                pos += nlit
+        else:
+            while buf[pos:pos+nlit].lower() == self._lit:
+                pos += nlit
+        return pos
+
+    def first_set(self, seen: frozenset=frozenset())-> Optional[FrozenSet[str]]:
+        if not self.literal:
+            return frozenset()
+        return frozenset(self.literal[0]) if self.case_sensitive else None
+
+    def nullable(self, seen: frozenset=frozenset())-> bool:
+        return not self.literal
+
+    def left_calls(self, seen: frozenset=frozenset())-> FrozenSet[str]:
+        return frozenset()
+
+    def emit_nfa(self, nfa: NFA, start: int, seen: frozenset=frozenset())-> int:
+        if not self.case_sensitive:
+            raise NotRegular("case insensitive literals cannot be converted to a DFA")
+        for char in self.literal:
+            state = nfa.state()
+            nfa.edge(start, ord(char), ord(char), state)
+            start = state
+        return start
+
+    def emit_python(self, ctx: Context)-> str:
+        if not self.literal:
+            return ''
+        return 'if not ({}):\n    return -1\npos += {}'.format(self._python_test(), self._nlit)
+
+    def emit_python_end(self, ctx: Context)-> str:
+        if not self.literal:
+            return 'pos'
+        return '(pos + {} if {} else -1)'.format(self._nlit, self._python_test())
+
+    def _python_test(self)-> str:
+        if self.case_sensitive:
+            return 'buf.startswith({!r}, pos)'.format(self.literal)
+        return 'buf[pos:pos+{}].lower() == {!r}'.format(self._nlit, self._lit)
+
+    def emit_program(self, program: Program):
+        if not self.literal:
+            return
+        if self.case_sensitive:
+            program.emit(LITERAL, program.const(self.literal), self._nlit)
+        else:
+            program.emit(ILITERAL, program.const(self._lit), self._nlit)
 
 
 class RangeMatcher(Matcher):
     """
     Matches single characters that fall in the given ranges
     """
+    __slots__ = ('lower', 'upper', 'lower_inclusive', 'upper_inclusive', 'lbound', 'ubound', 'range_size')
+
     def __init__(self, name: str, lower: str, upper: str, lower_inclusive: bool=True, upper_inclusive: bool=True):
         """
         :param name: string identifying this matcher
@@ -114,14 +401,58 @@ class RangeMatcher(Matcher):
         if self.range_size <= 0:
             logger.warning("RangeMatcher {} has empty range".format(name))
     
-    def match(self, source: str)-> Match:
-        if not source:
-            return Match(False, self.name, [], source)
-        head = source[0]
+    def match(self, buf: str, pos: int, memo: dict)-> Match:
+        if pos >= len(buf):
+            return self._fail
+        head = buf[pos]
         if self.lbound <= ord(head) <= self.ubound:
-            return Match(True, self.name, [head], source[1:])
+            return Match(True, self._name, [head], buf, pos, pos+1)
         else:
-            return Match(False, self.name, [], source)
+            return self._fail
+
+    def bulk_consume(self, buf: str, pos: int)-> int:
+        """
+        Matches characters in the range as many times as possible without building Matches
+        :return: the index in buf after the last repetition
+        """
+        lbound, ubound, n = self.lbound, self.ubound, len(buf)
+        while pos < n and lbound <= ord(buf[pos]) <= ubound:
+            pos += 1
+        return pos
+
+    def first_set(self, seen: frozenset=frozenset())-> Optional[FrozenSet[str]]:
+        if self.range_size > _MAX_DISPATCH_RANGE:
+            return None
+        return frozenset(chr(c) for c in range(self.lbound, self.ubound + 1))
+
+    def nullable(self, seen: frozenset=frozenset())-> bool:
+        return False
+
+    def left_calls(self, seen: frozenset=frozenset())-> FrozenSet[str]:
+        return frozenset()
+
+    def emit_nfa(self, nfa: NFA, start: int, seen: frozenset=frozenset())-> int:
+        end = nfa.state()
+        if self.lbound <= self.ubound:
+            nfa.edge(start, self.lbound, self.ubound, end)
+        return end
+
+    def emit_python(self, ctx: Context)-> str:
+        return 'if not ({}):\n    return -1\npos += 1'.format(self._python_test())
+
+    def emit_python_end(self, ctx: Context)-> str:
+        return '(pos + 1 if {} else -1)'.format(self._python_test())
+
+    def _python_test(self)-> str:
+        if self.ubound < self.lbound:
+            return 'False'
+        return 'pos < n and {!r} <= buf[pos] <= {!r}'.format(chr(self.lbound), chr(self.ubound))
+
+    def emit_program(self, program: Program):
+        if self.ubound < self.lbound:
+            program.emit(FAIL)
+            return
+        program.emit(RANGE, program.const(chr(self.lbound)), program.const(chr(self.ubound)))
     
     def __len__(self):
         return self.range_size
@@ -131,21 +462,52 @@ class OptionalMatcher(Matcher):
     """
     Optionally match the given matcher
     """
+    __slots__ = ('matcher',)
+
     def __init__(self, name: str, matcher: List[Matcher]):
         self.name = name
         self.matcher = matcher
 
-    def match(self, source: str):
-        result = self.matcher.match(source)
+    def match(self, buf: str, pos: int, memo: dict)-> Match:
+        result = self.matcher.match(buf, pos, memo)
         if result.successful:
-            return Match(True, self.name, [result], result.remainder)
-        return Match(True, self.name, [], source)
+            return Match(True, self._name, [result], buf, pos, result.end)
+        return Match(True, self._name, _EMPTY_TOKENS, buf, pos, pos)
+
+    def first_set(self, seen: frozenset=frozenset())-> Optional[FrozenSet[str]]:
+        return self.matcher.first_set(seen)
+
+    def nullable(self, seen: frozenset=frozenset())-> bool:
+        return True
+
+    def left_calls(self, seen: frozenset=frozenset())-> FrozenSet[str]:
+        return self.matcher.left_calls(seen)
+
+    def emit_nfa(self, nfa: NFA, start: int, seen: frozenset=frozenset())-> int:
+        body = nfa.state()
+        end = nfa.state()
+        nfa.epsilon(start, body)
+        nfa.epsilon(start, end)
+        nfa.epsilon(self.matcher.emit_nfa(nfa, body, seen), end)
+        return end
+
+    def emit_python(self, ctx: Context)-> str:
+        return 'end = {}\nif end >= 0:\n    pos = end'.format(self.matcher.emit_python_end(ctx))
+
+    def emit_program(self, program: Program):
+        choice = program.emit(CHOICE)
+        self.matcher.emit_program(program)
+        commit = program.emit(COMMIT)
+        program.patch(choice, program.here())
+        program.patch(commit, program.here())
 
 
 class AnyMatcher(Matcher):
     """
     Match one of a number of Matchers; returns the first successful Match
     """
+    __slots__ = ('matchers', '_dispatch', '_options', '_bindings')
+
     def __init__(self, name: str, *matchers: List[Matcher]):
         """
         :param name: string to identify this matcher
@@ -154,27 +516,137 @@ class AnyMatcher(Matcher):
         self.name = name
         if not matchers:
             logger.warning("No matchers provided to AnyMatcher {}".format(name))
-        self.matchers = matchers
+        self.matchers = self._flatten(matchers)
+        self._dispatch = self._first_char_dispatch(self.matchers)
+        # built on the first match, once the references in the options are bound,
+        # and rebuilt whenever a name they refer through is rebound
+        self._options = None
+        self._bindings = None
+
+    @staticmethod
+    def _first_char_dispatch(matchers):
+        """
+        When every option is a plain literal or character range and no two options
+        can start with the same character, at most one option can match at any position.
+        Returns a table from first character to that option, or None when the options
+        overlap or are not all literals and ranges.
+        :param matchers: the options of the AnyMatcher
+        """
+        dispatch = {}
+        for matcher in matchers:
+            if type(matcher) is LiteralMatcher and matcher.literal and matcher.case_sensitive:
+                firsts = [matcher.literal[0]]
+            elif type(matcher) is RangeMatcher and matcher.range_size <= _MAX_DISPATCH_RANGE:
+                firsts = [chr(c) for c in range(matcher.lbound, matcher.ubound + 1)]
+            else:
+                return None
+            for first in firsts:
+                if first in dispatch:
+                    return None
+                dispatch[first] = matcher
+        return dispatch
+
+    @staticmethod
+    def _flatten(matchers):
+        """
+        Inlines the options of anonymous nested AnyMatchers; choice is associative,
+        so (a | b) | c tries exactly the same options in the same order as a | b | c
+        """
+        flattened = []
+        for matcher in matchers:
+            if type(matcher) is AnyMatcher and not matcher.name:
+                flattened.extend(matcher.matchers)
+            else:
+                flattened.append(matcher)
+        return tuple(flattened)
     
-    def extend(self, matcher: Matcher):
+    def extend(self, matcher: Matcher)-> 'AnyMatcher':
         """
-        Mutates the current AnyMatcher by providing an additional option
+        Builds a new AnyMatcher with an additional option; the options of an
+        AnyMatcher are fixed once it is built
         :param matcher: the matcher to extend by
         """
-        self.matchers = list(self.matchers) + [matcher]
+        return AnyMatcher(self.name, *self.matchers, matcher)
 
-    def match(self, source: str)-> Match:
-        for matcher in self.matchers:
-            result = matcher.match(source)
+    def match(self, buf: str, pos: int, memo: dict)-> Match:
+        dispatch = self._dispatch
+        if dispatch is not None:
+            matcher = dispatch.get(buf[pos]) if pos < len(buf) else None
+            if matcher is not None:
+                result = matcher.match(buf, pos, memo)
+                if result.successful:
+                    return Match(True, self._name, [result], buf, pos, result.end)
+            return self._fail
+        if self._options is None or stale(self._bindings):
+            self._options = tuple(
+                (matcher, None if matcher.nullable() else matcher.first_set())
+                for matcher in self.matchers
+            )
+            self._bindings = bindings_of(self)
+        options = self._options
+        char = buf[pos] if pos < len(buf) else None
+        for matcher, first in options:
+            # an option that has to consume cannot match unless it starts with char
+            if first is not None and char not in first:
+                continue
+            result = matcher.match(buf, pos, memo)
             if result.successful:
-                return Match(True, self.name, [result], result.remainder)
-        return Match(False, self.name, [], source)
+                return Match(True, self._name, [result], buf, pos, result.end)
+        return self._fail
+
+    def first_set(self, seen: frozenset=frozenset())-> Optional[FrozenSet[str]]:
+        firsts = [matcher.first_set(seen) for matcher in self.matchers]
+        if None in firsts:
+            return None
+        return frozenset().union(*firsts)
+
+    def nullable(self, seen: frozenset=frozenset())-> bool:
+        return any(matcher.nullable(seen) for matcher in self.matchers)
+
+    def left_calls(self, seen: frozenset=frozenset())-> FrozenSet[str]:
+        return frozenset().union(*[matcher.left_calls(seen) for matcher in self.matchers])
+
+    def emit_nfa(self, nfa: NFA, start: int, seen: frozenset=frozenset())-> int:
+        end = nfa.state()
+        for matcher in self.matchers:
+            option = nfa.state()
+            nfa.epsilon(start, option)
+            nfa.epsilon(matcher.emit_nfa(nfa, option, seen), end)
+            if matcher.nullable():
+                # a nullable option always succeeds, so the options after it are never tried
+                break
+        return end
+
+    def emit_python(self, ctx: Context)-> str:
+        if not self.matchers:
+            return 'return -1'
+        lines = ['end = {}'.format(self.matchers[0].emit_python_end(ctx))]
+        for matcher in self.matchers[1:]:
+            lines.append('if end < 0:\n    end = {}'.format(matcher.emit_python_end(ctx)))
+        lines.append('if end < 0:\n    return -1\npos = end')
+        return '\n'.join(lines)
+
+    def emit_program(self, program: Program):
+        if not self.matchers:
+            program.emit(FAIL)
+            return
+        commits = []
+        for matcher in self.matchers[:-1]:
+            choice = program.emit(CHOICE)
+            matcher.emit_program(program)
+            commits.append(program.emit(COMMIT))
+            program.patch(choice, program.here())
+        self.matchers[-1].emit_program(program)
+        for commit in commits:
+            program.patch(commit, program.here())
 
 
 class SequenceMatcher(Matcher):
     """
     Matches the supplied Matchers in sequence; fails if any of them fail
     """
+    __slots__ = ('matchers',)
+
     def __init__(self, name: str, *matchers: List[Matcher]):
         """
         :param name: string to identify this matcher
@@ -183,85 +655,342 @@ class SequenceMatcher(Matcher):
         self.name = name
         if not matchers:
             logger.warning("Empty matchers supplied to SequenceMatcher {}".format(name))
-        self.matchers = matchers
+        self.matchers = self._fold(matchers)
+
+    @staticmethod
+    def _fold(matchers):
+        """
+        Inlines the steps of anonymous nested SequenceMatchers and merges runs of
+        anonymous LiteralMatchers into a single literal, so that m['a'] + m['b'] + m['c']
+        is matched with one startswith rather than three matcher calls
+        """
+        folded = []
+        for matcher in matchers:
+            steps = matcher.matchers if type(matcher) is SequenceMatcher and not matcher.name else [matcher]
+            for step in steps:
+                last = folded[-1] if folded else None
+                if (type(step) is LiteralMatcher and type(last) is LiteralMatcher
+                        and not step.name and not last.name
+                        and step.case_sensitive == last.case_sensitive):
+                    folded[-1] = LiteralMatcher('', last.literal + step.literal, last.case_sensitive)
+                else:
+                    folded.append(step)
+        return tuple(folded)
 
-    def extend(self, matcher: Matcher):
+    def extend(self, matcher: Matcher)-> 'SequenceMatcher':
         """
-        Mutates the current SequenceMatcher by extending the sequence 
+        Builds a new SequenceMatcher with the sequence extended; the steps of a
+        SequenceMatcher are fixed once it is built
         :param matcher: the matcher to extend by
         """
-        self.matchers = list(self.matchers) + [matcher]
+        return SequenceMatcher(self.name, *self.matchers, matcher)
 
-    def match(self, source: str)-> Match:
-        src = source
-        matched = []
-        for matcher in self.matchers:
-            result = matcher.match(src)
+    def match(self, buf: str, pos: int, memo: dict)-> Match:
+        matchers = self.matchers
+        end = pos
+        matched = [None] * len(matchers)
+        for i, matcher in enumerate(matchers):
+            result = matcher.match(buf, end, memo)
             if not result.successful:
-                return Match(False, self.name, [], source)
-            src = result.remainder
-            matched.append(result)
-        return Match(True, self.name, matched, src)
+                return self._fail
+            end = result.end
+            matched[i] = result
+        return Match(True, self._name, tuple(matched), buf, pos, end)
+
+    def first_set(self, seen: frozenset=frozenset())-> Optional[FrozenSet[str]]:
+        firsts = []
+        for matcher in self.matchers:
+            firsts.append(matcher.first_set(seen))
+            if not matcher.nullable(seen):
+                break
+        if None in firsts:
+            return None
+        return frozenset().union(*firsts)
+
+    def nullable(self, seen: frozenset=frozenset())-> bool:
+        return all(matcher.nullable(seen) for matcher in self.matchers)
+
+    def left_calls(self, seen: frozenset=frozenset())-> FrozenSet[str]:
+        calls = frozenset()
+        for matcher in self.matchers:
+            calls |= matcher.left_calls(seen)
+            if not matcher.nullable(seen):
+                break
+        return calls
+
+    def emit_nfa(self, nfa: NFA, start: int, seen: frozenset=frozenset())-> int:
+        for matcher in self.matchers:
+            start = matcher.emit_nfa(nfa, start, seen)
+        return start
+
+    def emit_python(self, ctx: Context)-> str:
+        return '\n'.join(filter(None, [matcher.emit_python(ctx) for matcher in self.matchers]))
+
+    def emit_program(self, program: Program):
+        for matcher in self.matchers:
+            matcher.emit_program(program)
 
 
 class RepeatedMatcher(Matcher):
     """
     Matches 0 or more times on the given matcher
     """
+    __slots__ = ('matcher', '_bulk', '_re', '_bindings')
+
     def __init__(self, name: str, matcher: Matcher):
         """
         :param name: string to identify this matcher
         :param matcher: the matcher which must match 0 or more times
         """
         self.name = name
-        if type(matcher) is RepeatedMatcher:
-            raise ValueError("Directly nesting RepeatedMatchers will result in infinite looping")
+        if matcher.nullable():
+            raise ValueError("Repeating a matcher that can match without consuming will result in infinite looping")
         self.matcher = matcher
+        # repetitions of a literal or a range are consumed in one call, and
+        # the Match for each repetition is only built if the tokens are read
+        self._bulk = type(matcher) is RangeMatcher or type(matcher) is LiteralMatcher
+        self._compile_re()
+
+    def _compile_re(self):
+        """
+        Repetitions of a single character class are consumed by a compiled regex; the
+        class looks through references, so it is rebuilt whenever a name they refer
+        through is rebound
+        """
+        char_class = _char_class(self.matcher, set())
+        self._re = re.compile('[{}]*'.format(char_class)) if char_class else None
+        self._bindings = bindings_of(self.matcher)
+
+    def match(self, buf: str, pos: int, memo: dict)-> Match:
+        if stale(self._bindings):
+            self._compile_re()
+        if self._re is not None:
+            return LazyMatch(self._name, buf, pos, self._re.match(buf, pos).end(), self._expand, memo)
+        if self._bulk:
+            return LazyMatch(self._name, buf, pos, self.matcher.bulk_consume(buf, pos), self._expand, memo)
+        return self._repeat(buf, pos, memo)
 
-    def match(self, source: str)-> Match:
-        loop_watch = False
+    def _expand(self, buf: str, start: int, end: int, memo: dict)-> list:
+        return self._repeat(buf, start, memo).tokens
+
+    def _repeat(self, buf: str, pos: int, memo: dict)-> Match:
         matched = []
-        src = source
-        while len(src) > 0:
-            result = self.matcher.match(src)
+        end = pos
+        while end < len(buf):
+            result = self.matcher.match(buf, end, memo)
             if result.successful:
-                if result.remainder == src:
-                    if not loop_watch:
-                        logger.warning("{} successfully matched without consuming")
-                        loop_watch = True
-                    else:
-                        raise Exception("Infinite loop detected in {}".format(self.name))
-                else:
-                    loop_watch = False
+                # checked in __init__ too, but a reference may since have been
+                # rebound to a matcher that can succeed without consuming
+                if result.end == end:
+                    raise ValueError("repetition matched without consuming, so it would loop forever")
                 matched.append(result)
-                src = result.remainder
+                end = result.end
             else: 
                 break
-        return Match(True, self.name, matched, src)
+        return Match(True, self._name, matched, buf, pos, end)
+
+    def first_set(self, seen: frozenset=frozenset())-> Optional[FrozenSet[str]]:
+        return self.matcher.first_set(seen)
+
+    def nullable(self, seen: frozenset=frozenset())-> bool:
+        return True
+
+    def left_calls(self, seen: frozenset=frozenset())-> FrozenSet[str]:
+        return self.matcher.left_calls(seen)
+
+    def emit_nfa(self, nfa: NFA, start: int, seen: frozenset=frozenset())-> int:
+        loop = nfa.state()
+        body = nfa.state()
+        end = nfa.state()
+        nfa.epsilon(start, loop)
+        nfa.epsilon(loop, body)
+        nfa.epsilon(loop, end)
+        nfa.epsilon(self.matcher.emit_nfa(nfa, body, seen), loop)
+        return end
+
+    def emit_python(self, ctx: Context)-> str:
+        if stale(self._bindings):
+            self._compile_re()
+        if self._re is not None:
+            return 'pos = {}.match(buf, pos).end()'.format(ctx.const(self._re))
+        return ('while pos < n:\n    end = {}\n    if end < 0:\n        break\n'
+                '    if end == pos:\n        raise ValueError("repetition matched without consuming, so it would loop forever")\n'
+                '    pos = end').format(self.matcher.emit_python_end(ctx))
+
+    def emit_program(self, program: Program):
+        choice = program.emit(CHOICE)
+        loop = program.here()
+        self.matcher.emit_program(program)
+        program.emit(PARTIAL_COMMIT, loop)
+        program.patch(choice, program.here())
 
 class RefMatcher(Matcher):
     """
-    Refers to a matcher in a registry by name 
+    Refers to a matcher in a registry by name; results are memoized per position
+    so that backtracking over a shared matcher never repeats work
     """
-    def __init__(self, ref_name: str, registry: dict):
+    __slots__ = ('registry', 'ref_name', '_memoize', '_bindings')
+
+    def __init__(self, ref_name: str, registry: Registry):
+        self.name = ref_name
         self.registry = registry
         self.ref_name = ref_name
+        # decided on the first match, and again whenever a name it refers through is rebound
+        self._memoize = True
+        self._bindings = None
 
-    def match(self, source: str)-> Match:
-        return self.registry[self.ref_name].match(source)
+    def _classify(self):
+        """
+        A reference to a rule that is already being matched at the same position
+        fails, as it does in vm.execute. So when the rule can reach a left recursive
+        rule without consuming, its result depends on which rules are being matched
+        around it, and it is matched afresh every time rather than memoized.
+        """
+        registry = self.registry
+        reached = registry[self.ref_name].left_calls() | {self.ref_name}
+        self._memoize = not any(
+            name in registry[name].left_calls(frozenset([name])) for name in reached if name in registry)
+        self._bindings = bindings_of(self)
+
+    def match(self, buf: str, pos: int, memo: dict)-> Match:
+        matcher = self.registry[self.ref_name]
+        if self._bindings is None or stale(self._bindings):
+            self._classify()
+        table = memo.get(id(matcher))
+        if table is None:
+            table = memo[id(matcher)] = [None] * (len(buf) + 1)
+        result = table[pos]
+        if result is None:
+            table[pos] = _ACTIVE
+            result = matcher.match(buf, pos, memo)
+            if self._memoize:
+                table[pos] = result
+            else:
+                table[pos] = None
+        elif result is _ACTIVE:
+            # re-entered at the position it is being matched at: fail, so that left
+            # recursion cannot recurse forever
+            return matcher._fail
+        return result
+
+    def first_set(self, seen: frozenset=frozenset())-> Optional[FrozenSet[str]]:
+        # a reference back into itself fails, so it adds nothing
+        if self.ref_name in seen:
+            return frozenset()
+        return self.registry[self.ref_name].first_set(seen | {self.ref_name})
+
+    def nullable(self, seen: frozenset=frozenset())-> bool:
+        # a reference back into itself fails, as it does when matching
+        if self.ref_name in seen:
+            return False
+        return self.registry[self.ref_name].nullable(seen | {self.ref_name})
+
+    def left_calls(self, seen: frozenset=frozenset())-> FrozenSet[str]:
+        if self.ref_name in seen:
+            return frozenset([self.ref_name])
+        return self.registry[self.ref_name].left_calls(seen | {self.ref_name}) | {self.ref_name}
+
+    def emit_nfa(self, nfa: NFA, start: int, seen: frozenset=frozenset())-> int:
+        if self.ref_name in seen:
+            raise NotRegular("{} refers to itself".format(self.ref_name))
+        return self.registry[self.ref_name].emit_nfa(nfa, start, seen | {self.ref_name})
+
+    def emit_python(self, ctx: Context)-> str:
+        return 'pos = {}\nif pos < 0:\n    return -1'.format(self.emit_python_end(ctx))
+
+    def emit_python_end(self, ctx: Context)-> str:
+        return '{}(buf, pos, n, active)'.format(ctx.rule(self.registry[self.ref_name], self.ref_name))
+
+    def emit_program(self, program: Program):
+        program.call(self.ref_name, self.registry[self.ref_name])
 
 class NotMatcher(Matcher):
     """
     If the provided matcher fails, this succeeds, taking the first character as its token
     """
+    __slots__ = ('matcher',)
+
     def __init__(self, name: str, matcher: Matcher):
         self.name = name
         self.matcher = matcher
 
-    def match(self, source: str)-> Match:
-        if not source:
-            return Match(False, self.name, '', '')
-        result = self.matcher.match(source)
+    def match(self, buf: str, pos: int, memo: dict)-> Match:
+        if pos >= len(buf):
+            return self._fail
+        result = self.matcher.match(buf, pos, memo)
         if not result.successful:
-            return Match(True, self.name, [source[0]], source[1:])
-        return Match(False, self.name, '', source)
+            return Match(True, self._name, [buf[pos]], buf, pos, pos+1)
+        return self._fail
+
+    def nullable(self, seen: frozenset=frozenset())-> bool:
+        return False
+
+    def left_calls(self, seen: frozenset=frozenset())-> FrozenSet[str]:
+        return self.matcher.left_calls(seen)
+
+    def emit_python(self, ctx: Context)-> str:
+        return 'if pos >= n or {} >= 0:\n    return -1\npos += 1'.format(self.matcher.emit_python_end(ctx))
+
+    def emit_program(self, program: Program):
+        choice = program.emit(CHOICE)
+        self.matcher.emit_program(program)
+        program.emit(FAIL_TWICE)
+        program.patch(choice, program.here())
+        program.emit(ANY)
+
+
+class DFAMatcher(Matcher):
+    """
+    Matches with a DFA built from the given matcher; only the text matched is kept,
+    as a single token, rather than the tree of Matches the given matcher would build
+    """
+    __slots__ = ('matcher', 'transitions', 'accept')
+
+    def __init__(self, name: str, matcher: Matcher):
+        """
+        :param name: string to identify this matcher
+        :param matcher: the matcher to convert; raises NotRegular if there is no equivalent DFA
+        """
+        self.name = name
+        self.matcher = matcher
+        nfa = NFA()
+        start = nfa.state()
+        end = matcher.emit_nfa(nfa, start)
+        self.transitions, self.accept = determinize(nfa, start, end)
+
+    def match(self, buf: str, pos: int, memo: dict)-> Match:
+        transitions, accept = self.transitions, self.accept
+        state = 0
+        end = pos if state in accept else -1
+        i, n = pos, len(buf)
+        while i < n:
+            state = transitions[state].get(buf[i])
+            if state is None:
+                break
+            i += 1
+            if state in accept:
+                end = i
+        if end < 0:
+            return self._fail
+        return Match(True, self._name, [buf[pos:end]], buf, pos, end)
+
+    def first_set(self, seen: frozenset=frozenset())-> Optional[FrozenSet[str]]:
+        return frozenset(self.transitions[0])
+
+    def nullable(self, seen: frozenset=frozenset())-> bool:
+        return 0 in self.accept
+
+    def left_calls(self, seen: frozenset=frozenset())-> FrozenSet[str]:
+        return self.matcher.left_calls(seen)
+
+    def emit_nfa(self, nfa: NFA, start: int, seen: frozenset=frozenset())-> int:
+        return self.matcher.emit_nfa(nfa, start, seen)
+
+    def emit_python(self, ctx: Context)-> str:
+        return self.matcher.emit_python(ctx)
+
+    def emit_python_end(self, ctx: Context)-> str:
+        return self.matcher.emit_python_end(ctx)
+
+    def emit_program(self, program: Program):
+        self.matcher.emit_program(program)
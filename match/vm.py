@@ -0,0 +1,201 @@
+"""
+A backtracking parsing machine in the style of LPeg's. A matcher tree is
+compiled once into a flat Program, and the Program is then run against a
+source string by a single loop in a single Python frame, rather than by a
+chain of match() calls down the tree.
+
+Instruction i of a Program is (ops[i], a[i], b[i]); the meaning of the two
+arguments depends on the opcode.
+"""
+
+LITERAL = 0         # match consts[a], which is b characters long
+ILITERAL = 1        # match consts[a] ignoring case; it is b characters long
+RANGE = 2           # match one character between consts[a] and consts[b] inclusive
+ANY = 3             # match any one character
+CHOICE = 4          # push a backtrack entry resuming at a
+COMMIT = 5          # drop the top backtrack entry and jump to a
+PARTIAL_COMMIT = 6  # move the top backtrack entry to the current position and jump to a
+FAIL_TWICE = 7      # drop the top backtrack entry, then fail
+FAIL = 8            # fail
+CALL = 9            # push the return address and jump to rule b, which starts at a
+RETURN = 10         # pop the return address and jump to it
+END = 11            # succeed
+
+
+class Program:
+    """
+    A compiled matcher; built by Matcher.compile
+    """
+    def __init__(self):
+        self.ops = []
+        self.a = []
+        self.b = []
+        self.consts = []
+        # consts re-encoded for running against bytes; set by finish
+        self.bconsts = None
+        # dense ids of the called rules, by name
+        self.rule_ids = {}
+        self._rules = {}
+        self._calls = []
+
+    def emit(self, op: int, a: int=0, b: int=0)-> int:
+        """
+        Appends an instruction
+        :return: the address of the new instruction
+        """
+        self.ops.append(op)
+        self.a.append(a)
+        self.b.append(b)
+        return len(self.ops) - 1
+
+    def here(self)-> int:
+        """
+        :return: the address of the next instruction to be emitted
+        """
+        return len(self.ops)
+
+    def patch(self, pc: int, target: int):
+        """
+        Points the jump at pc to target
+        """
+        self.a[pc] = target
+
+    def const(self, value)-> int:
+        """
+        Adds a constant to the program
+        :return: the index of the constant
+        """
+        self.consts.append(value)
+        return len(self.consts) - 1
+
+    def call(self, name: str, matcher):
+        """
+        Emits a call to the rule bound to name; each rule is compiled once, as a subroutine
+        """
+        rule = self.rule_ids.setdefault(name, len(self.rule_ids))
+        self._calls.append((self.emit(CALL, 0, rule), name, matcher))
+
+    def finish(self)-> 'Program':
+        """
+        Terminates the main program and appends the subroutines for all called rules
+        """
+        self.emit(END)
+        while self._calls:
+            pc, name, matcher = self._calls.pop()
+            if name not in self._rules:
+                self._rules[name] = self.here()
+                matcher.emit_program(self)
+                self.emit(RETURN)
+            self.patch(pc, self._rules[name])
+        self.bconsts = list(self.consts)
+        for pc, op in enumerate(self.ops):
+            if op == LITERAL or op == ILITERAL:
+                # a literal that is not ASCII encodes to bytes no ASCII input contains
+                self.bconsts[self.a[pc]] = self.consts[self.a[pc]].encode('utf-8')
+            elif op == RANGE:
+                self.bconsts[self.a[pc]] = ord(self.consts[self.a[pc]])
+                self.bconsts[self.b[pc]] = ord(self.consts[self.b[pc]])
+        return self
+
+    def run(self, source: str, pos: int=0)-> int:
+        """
+        ASCII sources are run as bytes, which the loop indexes and compares faster
+        :return: the index in source at which the match ended, or -1 if it failed
+        """
+        if source.isascii():
+            return execute(self, source.encode('ascii'), pos, self.bconsts)
+        return execute(self, source, pos)
+
+
+def execute(program: Program, buf, pos: int, consts: list=None)-> int:
+    """
+    Runs program against buf starting from pos
+    :param buf: a str, or bytes to run against the program's bconsts
+    :param consts: the constants to use in place of the program's consts
+
+    A rule called again at the position it is already being matched at fails,
+    as RefMatcher does, so left recursion cannot loop forever. The rules being
+    matched are tracked as one flag per (rule, position) in active.
+    :return: the index in buf at which the match ended, or -1 if it failed
+    """
+    ops, a, b = program.ops, program.a, program.b
+    if consts is None:
+        consts = program.consts
+    n = len(buf)
+    width = n + 1
+    active = bytearray(len(program.rule_ids) * width)
+    # entries are pairs: (resume address, position) for a backtrack entry,
+    # (return address, -1 - slot) for a call, where slot is its flag in active
+    stack = []
+    pc = 0
+    while True:
+        op = ops[pc]
+        if op == LITERAL:
+            if buf.startswith(consts[a[pc]], pos):
+                pos += b[pc]
+                pc += 1
+                continue
+        elif op == RANGE:
+            if pos < n and consts[a[pc]] <= buf[pos] <= consts[b[pc]]:
+                pos += 1
+                pc += 1
+                continue
+        elif op == CHOICE:
+            stack.append(a[pc])
+            stack.append(pos)
+            pc += 1
+            continue
+        elif op == COMMIT:
+            del stack[-2:]
+            pc = a[pc]
+            continue
+        elif op == PARTIAL_COMMIT:
+            if pos >= n:
+                # repetition stops at the end of the input
+                del stack[-2:]
+                pc += 1
+                continue
+            if pos == stack[-1]:
+                raise ValueError("repetition matched without consuming, so it would loop forever")
+            stack[-1] = pos
+            pc = a[pc]
+            continue
+        elif op == CALL:
+            slot = b[pc] * width + pos
+            if not active[slot]:
+                active[slot] = 1
+                stack.append(pc + 1)
+                stack.append(-1 - slot)
+                pc = a[pc]
+                continue
+        elif op == RETURN:
+            active[-1 - stack.pop()] = 0
+            pc = stack.pop()
+            continue
+        elif op == ANY:
+            if pos < n:
+                pos += 1
+                pc += 1
+                continue
+        elif op == ILITERAL:
+            end = pos + b[pc]
+            if buf[pos:end].lower() == consts[a[pc]]:
+                pos = end
+                pc += 1
+                continue
+        elif op == FAIL_TWICE:
+            del stack[-2:]
+        elif op == END:
+            return pos
+        # the instruction failed: resume from the most recent backtrack entry,
+        # discarding any calls made since it was pushed
+        while stack:
+            saved = stack.pop()
+            resume = stack.pop()
+            if saved >= 0:
+                pos = saved
+                pc = resume
+                break
+            active[-1 - saved] = 0
+        else:
+            return -1